@@ -0,0 +1,79 @@
+import time
+
+# Change records older than this are left for DynamoDB's TTL sweeper to clean up (the table's TTL attribute must be
+# set to "expires"). Nodes that fall this far behind just drop their whole cache.
+RECORD_LIFETIME = 24 * 60 * 60
+
+# Largest gap in the sequence a node will catch up on record by record, also the BatchGetItem key limit
+MAX_CATCHUP = 100
+
+
+class ChangeFeed:
+	"""Monotonically increasing change sequence shared by every node, stored in the catalog table. Each bump also
+	leaves a record of which cache keys it touched so other nodes only have to drop those."""
+
+	def __init__(self, table):
+		self.table = table
+
+	def publish(self, *keys):
+		"""Bump the change sequence and record the keys that changed. Returns the new sequence number."""
+		ret = self.table.update_item(
+			Key={"bucket": "changes"},
+			UpdateExpression="ADD seq :one",
+			ExpressionAttributeValues={":one": 1},
+			ReturnValues="UPDATED_NEW"
+		)
+		seq = int(ret["Attributes"]["seq"])
+		self.table.put_item(
+			Item={
+				"bucket": "change#{}".format(seq),
+				"keys": set(keys),
+				"expires": int(time.time()) + RECORD_LIFETIME
+			}
+		)
+		return seq
+
+	def current(self):
+		"""Get the latest change sequence number; a single-item read, cheap enough to poll"""
+		ret = self.table.get_item(Key={"bucket": "changes"}, ConsistentRead=True)
+		return int(ret["Item"]["seq"]) if "Item" in ret.keys() else 0
+
+	def since(self, seq, latest):
+		"""Get the set of keys changed after seq up to and including latest, or None if that can't be worked out
+		(too far behind, or a record isn't visible yet) and the caller should assume everything changed"""
+		if latest - seq > MAX_CATCHUP:
+			return None
+		if latest <= seq:
+			return set()
+		names = ["change#{}".format(n) for n in range(seq + 1, latest + 1)]
+		ret = self.table.meta.client.batch_get_item(
+			RequestItems={self.table.name: {"Keys": [{"bucket": name} for name in names], "ConsistentRead": True}}
+		)
+		records = ret["Responses"].get(self.table.name, [])
+		if len(records) != len(names):
+			return None
+		keys = set()
+		for record in records:
+			keys |= set(record["keys"])
+		return keys
+
+
+class LocalChangeFeed:
+	"""In-process stand-in for ChangeFeed, for tests and single-node setups (server.change-feed = "local"). Nothing
+	leaves the process, so don't use it with more than one node."""
+
+	def __init__(self):
+		self.records = []
+
+	def publish(self, *keys):
+		self.records.append(set(keys))
+		return len(self.records)
+
+	def current(self):
+		return len(self.records)
+
+	def since(self, seq, latest):
+		keys = set()
+		for record in self.records[seq:latest]:
+			keys |= record
+		return keys
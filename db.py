@@ -1,37 +1,82 @@
-import base64
 import html
 import json
 import os
-import re
+import threading
 import time
 import uuid
 
 import boto3
 import magic
 from bcrypt import hashpw, gensalt, checkpw
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 
+from changes import ChangeFeed
 from maven import store_jar_in_maven_repo
 
+# Number of most recent versions kept inline with each API; the full history lives in the versions table
+HISTORY_PREVIEW = 5
+
+MIME = magic.Magic(mime=True)
+
+
+def condition_failed(error):
+	"""Whether a ClientError is just a conditional write losing out to a concurrent one"""
+	return error.response["Error"]["Code"] == "ConditionalCheckFailedException"
+
 
 class APIDatabase:
-	def __init__(self, img_dir, jar_dir, table, region, bucket_name, access_key, secret_key):
+	def __init__(self, img_dir, jar_dir, table, catalog_table, versions_table, region, bucket_name, access_key, secret_key,
+				 changes=None, poll_interval=2):
 		self.img_dir = img_dir
 		self.jar_dir = jar_dir
 		self.bucket = boto3.resource("s3", aws_access_key_id=access_key, aws_secret_access_key=secret_key).Bucket(bucket_name)
-		self.dynamo = boto3.resource("dynamodb", aws_access_key_id=access_key, aws_secret_access_key=secret_key, region_name=region).Table(table)
+		dynamo = boto3.resource("dynamodb", aws_access_key_id=access_key, aws_secret_access_key=secret_key, region_name=region)
+		self.dynamo = dynamo.Table(table)
+		self.catalog = dynamo.Table(catalog_table)
+		self.versions = dynamo.Table(versions_table)
+
+		# User items are cached per node. Every write bumps the shared change sequence, and nodes poll it to find out
+		# which cached users someone else has touched. The full scan is kept as a username -> item dict, and only the
+		# users marked stale get re-fetched into it. Every invalidation bumps the generation; results fetched while it
+		# moved are served but not cached, since they may predate the change.
+		self.changes = ChangeFeed(self.catalog) if changes is None else changes
+		self.poll_interval = poll_interval
+		self.last_poll = time.time()
+		self.seen = self.changes.current()
+		self.lock = threading.Lock()
+		self.generation = 0
+		self.user_cache = {}
+		self.users_cache = None
+		self.stale_users = set()
+
+		# Aggregate counters are maintained incrementally from here on out, but they have to start from somewhere
+		if "Item" not in self.catalog.get_item(Key={"bucket": "totals"}).keys():
+			self.rebuild_catalog_stats()
+		if "Item" not in self.catalog.get_item(Key={"bucket": "versions-migrated"}).keys():
+			self.migrate_version_history()
 
 	def get_user(self, username):
 		"""Get a user's entry, or None if they don't exist"""
+		self.__sync()
+		user = self.user_cache.get(username)
+		if user is not None:
+			return user
+		generation = self.generation
 		try:
-			ret = self.dynamo.get_item(Key={"username": username})
+			ret = self.dynamo.get_item(Key={"username": username}, ConsistentRead=True)
 			if "Item" not in ret.keys():
 				return None
+			with self.lock:
+				if self.generation == generation:
+					self.user_cache[username] = ret["Item"]
 			return ret["Item"]
 		except Exception:
 			return None
 
 	def register_user(self, username, password):
 		"""Add a user to the database, if they don't already exist."""
+		self.__sync(force=True)
 		if self.get_user(username) is not None:
 			return False
 
@@ -48,20 +93,35 @@ class APIDatabase:
 				"apis": []
 			}
 		)
+		self.__publish(username)
 		return True
 
 	def delete_user(self, username):
 		"""Delete a user from the database"""
+		self.__sync(force=True)
 		user = self.get_user(username)
 		if user is None:
 			return
+
+		# Work from the item as it was at the moment it was deleted, so APIs hidden concurrently aren't counted twice
+		try:
+			user = self.dynamo.delete_item(
+				Key={"username": username},
+				ConditionExpression="attribute_exists(username)",
+				ReturnValues="ALL_OLD"
+			)["Attributes"]
+		except ClientError as e:
+			if not condition_failed(e):
+				raise
+			return
 		user["username"] = "DELETED_" + user["username"]
 		user["active"] = 0
 		for api in user["apis"]:
+			if api["display"] == 1:
+				self.__adjust_catalog(api["term"], api["year"], count=-1, size=-int(api["size"]))
 			api["display"] = 0
-
-		self.dynamo.delete_item(Key={"username": username})
 		self.dynamo.put_item(Item=user)
+		self.__publish(username, user["username"])
 
 	def change_passwd(self, username, password):
 		"""Change a user's password"""
@@ -74,6 +134,7 @@ class APIDatabase:
 				":password": hashpw(password, gensalt())
 			}
 		)
+		self.__publish(username)
 
 	def change_username(self, username, new_username):
 		"""Change a username"""
@@ -86,6 +147,7 @@ class APIDatabase:
 				":username": new_username
 			}
 		)
+		self.__publish(username, new_username)
 
 	def set_admin(self, username, admin):
 		"""Set whether a user is an admin or not"""
@@ -98,9 +160,11 @@ class APIDatabase:
 				":admin": admin
 			}
 		)
+		self.__publish(username)
 
 	def authenticate(self, username, password):
 		"""Authenticate username/password combo, returns tuple of booleans (one for auth, one for admin, one for locked"""
+		self.__sync(force=True)
 		user = self.get_user(username)
 		if user is None or not bool(user["active"]):
 			return False, False, False
@@ -116,6 +180,7 @@ class APIDatabase:
 					":time": int(time.time())
 				}
 			)
+			self.__publish(username)
 		else:
 			return False, False, False
 
@@ -131,18 +196,20 @@ class APIDatabase:
 				":locked": locked
 			}
 		)
+		self.__publish(username)
 
-	def create_api(self, username, name, contact, description, term, year, team):
-		"""Create base API entry, returns API ID on success"""
-		if not self.__validate_args(contact=contact, term=term, year=year, team=team):
-			return False, "Bad arguments"
+	def create_api(self, username, info):
+		"""Create base API entry from an info dict cleaned up by schemas.parse_api_info, returns API ID on success"""
+		name, contact, description = info["name"], info["contact"], info["description"]
+		term, year, team = info["term"], info["year"], info["team"]
+		self.__sync(force=True)
 
 		# Construct artifact ID and group ID
 		artifactID = str().join(c for c in name if c.isalnum())
 		groupID = "edu.wpi.cs3733." + term.lower() + str(year)[2:] + ".team" + team.upper()
 
 		# Enforce uniqueness constraint on artifact ID + group ID
-		users = self.dynamo.scan()["Items"]
+		users = self.__scan_users()
 		for user in users:
 			for api in user["apis"]:
 				if api["artifactID"] == artifactID and api["groupID"] == groupID:
@@ -169,7 +236,8 @@ class APIDatabase:
 			"version": "0.0.0",
 			"lastupdate": int(time.time()),
 			"display": 1,
-			"versions": []
+			"versions": [],
+			"version_count": 0
 		}
 
 		# TODO Enforce group+artifact uniqueness
@@ -182,14 +250,18 @@ class APIDatabase:
 				":api": [api],
 			}
 		)
+		self.__adjust_catalog(term, year, count=1, total_count=1)
+		self.__publish(username)
 
 		return True, apiID
 
-	def update_api(self, username, api_id, **kwargs):
-		"""Update an API entry... anything about it. Returns whether operation succeeded, false+msg if it didn't"""
+	def update_api(self, username, api_id, info):
+		"""Update an API entry... anything about it, using an info dict already cleaned up by schemas.parse_api_info.
+		Returns whether operation succeeded, false+msg if it didn't"""
 
 		# VERIFICATION
 		# Verify ownership of API (but skip if user is admin)
+		self.__sync(force=True)
 		current_user = self.get_user(username)
 		if current_user is None:
 			return False, "Could not find user issuing update"
@@ -201,34 +273,39 @@ class APIDatabase:
 		current_api = list(filter(lambda api: api_id == api["id"], current_user["apis"]))[0]
 		current_api_index = current_user["apis"].index(current_api)
 
-		# Since these values are basically passed in RAW into the db, it's critical to allow only select keywords
-		allowed = ("name", "version", "contact", "term", "year", "team", "description", "image", "jar")
-		if not all(arg in allowed for arg in kwargs.keys()):
-			return False, "Illegal API change argument"
-		if not self.__validate_args(**kwargs):
-			return False, "Arguments failed validity check"
+		# Jar files are checked before anything is written so a bad upload doesn't leave a half-applied update
+		if "jar" in info.keys():
+			file_type = MIME.from_buffer(info["jar"])
+			if file_type.find("application/zip") == -1 and file_type.find('application/java-archive') == -1:
+				return False, "Received file for API but it wasn't a jar file"
 
 		# UPDATES
-
-		# Slightly hacky: The arguments in the args dict are the same as the column names in the database API table...
-		# OH YEAH! Just pass those things in directly into dynamo
-		for key, value in kwargs.items():
-			if key == "version" or key == "image" or key == "jar":
-				continue
-			if key == "description" or key == "name" or key == "contact":
-				kwargs[key] = html.escape(value)
-			self.dynamo.update_item(
+		# Slightly hacky: The keys in the info dict are the same as the column names in the database API table...
+		# OH YEAH! Just pass those things in directly into dynamo, all in one go
+		props = [key for key in ("name", "contact", "term", "year", "team", "description") if key in info.keys()]
+		if len(props) > 0:
+			old = self.dynamo.update_item(
 				Key={"username": current_user["username"]},
-				UpdateExpression="SET apis[{}].#prop = :val".format(current_api_index),  # KILL ME. Please.
-				ExpressionAttributeNames={"#prop": key},
-				ExpressionAttributeValues={":val": value}
-			)
-
-		# Image processing: decode b64-encoded images, store them in img/directory for now, using API ID
-		mime = magic.Magic(mime=True)
-		if "image" in kwargs.keys():
-			data = base64.standard_b64decode(kwargs["image"])
-			mtype = mime.from_buffer(data)
+				UpdateExpression="SET " + ", ".join("apis[{}].#p{} = :v{}".format(current_api_index, i, i) for i in range(len(props))),  # KILL ME. Please.
+				ExpressionAttributeNames={"#p{}".format(i): key for i, key in enumerate(props)},
+				ExpressionAttributeValues={
+					":v{}".format(i): html.escape(info[key]) if key in ("name", "contact", "description") else info[key]
+					for i, key in enumerate(props)
+				},
+				ReturnValues="ALL_OLD"
+			)["Attributes"]["apis"][current_api_index]
+
+			# Term/year changes move the API to another catalog bucket; totals stay the same. Going by the item as
+			# it was right before this write keeps the counters straight when a hide or upload races with it.
+			term = info.get("term", old["term"])
+			year = info.get("year", old["year"])
+			if self.__term_key(term, year) != self.__term_key(old["term"], old["year"]) and old["display"] == 1:
+				self.__adjust_catalog(old["term"], old["year"], count=-1, size=-int(old["size"]))
+				self.__adjust_catalog(term, year, count=1, size=int(old["size"]))
+
+		# Image processing: store images in img/directory for now, using API ID
+		if "image" in info.keys():
+			mtype = MIME.from_buffer(info["image"])
 			if mtype.find("image/") != -1:
 
 				# If the DB already has a file listed for this API, delete it
@@ -244,62 +321,64 @@ class APIDatabase:
 					UpdateExpression="SET apis[{}].image_url = :img".format(current_api_index),
 					ExpressionAttributeValues={":img": filename}
 				)
-				self.bucket.put_object(Key=filename, Body=data)
+				self.bucket.put_object(Key=filename, Body=info["image"])
 			else:
 				print("Received image file for API " + api_id + ", but it wasn't an image!")
 
-			# Jar processing: decode b64-encoded jar files, store them in work. Make sure that an appropriate version string
-			# is provided, otherwise we can't add it to the repo.
-		if "jar" in kwargs.keys() and "version" in kwargs.keys():
-			data = base64.standard_b64decode(kwargs["jar"])
-			file_type = mime.from_buffer(data)
-			if file_type.find("application/zip") == -1 and file_type.find('application/java-archive') == -1:
-				return False, "Received file for API but it wasn't a jar file"
-
-			# Update version, size, timestamp
-			version_string = re.search("\d+\.\d+\.\d+", kwargs["version"]).group(0)  # Safe because we already validated it
-			self.dynamo.update_item(
-				Key={"username": current_user["username"]},
-				UpdateExpression="SET apis[{}].version = :version".format(current_api_index),
-				ExpressionAttributeValues={":version": version_string}
-			)
-			self.dynamo.update_item(
-				Key={"username": current_user["username"]},
-				UpdateExpression="SET apis[{}].size= :size".format(current_api_index),
-				ExpressionAttributeValues={":size": int(len(data)/1000000)}
-			)
-			self.dynamo.update_item(
-				Key={"username": current_user["username"]},
-				UpdateExpression="SET apis[{}].lastupdate = :time".format(current_api_index),
-				ExpressionAttributeValues={":time": int(time.time())}
-			)
+		# Jar processing: store jar files in the maven repo. The schema guarantees they come with a version.
+		if "jar" in info.keys():
+			# Update version, size, timestamp, and add new entry in version table, keeping only a short preview of
+			# it inline. TODO Enforce version validity!
+			version = info["version"]
+			size = int(len(info["jar"])/1000000)
 
-			# Add new entry in version table. TODO Enforce version validity!
-			self.dynamo.update_item(
+			# Claim the next sequence number atomically, so concurrent uploads can't both write the same record
+			seq = int(self.dynamo.update_item(
 				Key={"username": current_user["username"]},
-				UpdateExpression="SET apis[{}].versions= list_append(apis[{}].versions, :version)".format(current_api_index, current_api_index),
-				ExpressionAttributeValues={
-					":version": [{
-						"vnumber": version_string,
-						"info": kwargs["version"].replace(version_string, "").lstrip()
-					}]
-				}
-			)
+				UpdateExpression="SET apis[{0}].version_count = if_not_exists(apis[{0}].version_count, :count) + :one".format(current_api_index),
+				ExpressionAttributeValues={":count": len(current_api["versions"]), ":one": 1},
+				ReturnValues="UPDATED_NEW"
+			)["Attributes"]["apis"][0]["version_count"])
+			self.versions.put_item(Item=dict(version, api=api_id, seq=seq))
+			recent = self.versions.query(KeyConditionExpression=Key("api").eq(api_id), ScanIndexForward=False,
+										 Limit=HISTORY_PREVIEW, ConsistentRead=True)["Items"]
+
+			# Only the newest upload gets to set the current version, size, and preview
+			try:
+				old = self.dynamo.update_item(
+					Key={"username": current_user["username"]},
+					UpdateExpression="SET apis[{0}].version = :version, apis[{0}].size = :size, apis[{0}].lastupdate = :time, "
+									 "apis[{0}].versions = :recent".format(current_api_index),
+					ConditionExpression="apis[{0}].version_count = :seq".format(current_api_index),
+					ExpressionAttributeValues={
+						":version": version["vnumber"],
+						":size": size,
+						":time": int(time.time()),
+						":recent": [{"vnumber": v["vnumber"], "info": v["info"]} for v in reversed(recent)],
+						":seq": seq
+					},
+					ReturnValues="ALL_OLD"
+				)["Attributes"]["apis"][current_api_index]
+				size_delta = size - int(old["size"])
+				if size_delta != 0:
+					displayed = old["display"] == 1
+					self.__adjust_catalog(old["term"], old["year"], size=size_delta if displayed else 0, total_size=size_delta)
+			except ClientError as e:
+				if not condition_failed(e):
+					raise
 
 			store_jar_in_maven_repo(base_dir=self.jar_dir,
 									group=current_api["groupID"],
 									artifact=current_api["artifactID"],
-									version=version_string,
+									version=version["vnumber"],
 									bucket=self.bucket,
-									file=base64.standard_b64decode(kwargs["jar"]))
-
-			# Jars must be accompanied by versions; if we have one but not the other, throw an error
-		elif ("jar" in kwargs.keys() and "version" not in kwargs.keys()) or ("version" in kwargs.keys() and "jar" not in kwargs.keys()):
-			return False, "Jar files must be accompanied by versions" if "jar" in kwargs.keys() else "Empty versions disallowed"
+									file=info["jar"])
+		self.__publish(current_user["username"])
 		return True, "Updated API"
 
 	def delete_api(self, username, api_id):
 		"""Delete an API and its associated image. Jar files are left intact since others may rely on them."""
+		self.__sync(force=True)
 		current_user = self.get_user(username)
 		if current_user is None:
 			return False
@@ -310,11 +389,22 @@ class APIDatabase:
 				return False
 		current_api = list(filter(lambda api: api_id == api["id"], current_user["apis"]))[0]
 		current_api_index = current_user["apis"].index(current_api)
-		self.dynamo.update_item(
-			Key={"username": current_user["username"]},
-			UpdateExpression="SET apis[{}].display = :n".format(current_api_index),
-			ExpressionAttributeValues={":n": 0}
-		)
+
+		# Only whoever actually flips the flag gets to adjust the counters, so concurrent deletes can't count twice
+		try:
+			old = self.dynamo.update_item(
+				Key={"username": current_user["username"]},
+				UpdateExpression="SET apis[{0}].display = :n".format(current_api_index),
+				ConditionExpression="apis[{0}].display = :y".format(current_api_index),
+				ExpressionAttributeValues={":n": 0, ":y": 1},
+				ReturnValues="ALL_OLD"
+			)["Attributes"]["apis"][current_api_index]
+		except ClientError as e:
+			if not condition_failed(e):
+				raise
+			return True  # Already hidden
+		self.__adjust_catalog(old["term"], old["year"], count=-1, size=-int(old["size"]))
+		self.__publish(current_user["username"])
 		return True
 
 	def get_api_info(self, api_id=None, api=None, user=None):
@@ -338,14 +428,52 @@ class APIDatabase:
 			"year": api["year"],
 			"team": api["team"],
 			"creator": user["username"] if user is None else user,
-			"history": ["{}: {}".format(version["vnumber"], version["info"]) for version in api["versions"]]
+			"history": ["{}: {}".format(version["vnumber"], version["info"]) for version in api["versions"]],
+			"historyCount": int(api.get("version_count", len(api["versions"])))
 		}
 
 		return ret
 
+	def get_api_history(self, api_id, before=None, limit=20):
+		"""Get a page of an API's version history, newest first. Returns the entries and the cursor to pass as
+		'before' for the next page (None if this was the last one), or None if there's no such API."""
+		api, _ = self.__get_api_chain_by_id(api_id)
+		if api is False:
+			return None
+		condition = Key("api").eq(api_id)
+		if before is not None:
+			condition = condition & Key("seq").lt(before)
+		ret = self.versions.query(KeyConditionExpression=condition, ScanIndexForward=False, Limit=limit)
+		history = ["{}: {}".format(version["vnumber"], version["info"]) for version in ret["Items"]]
+		cursor = int(ret["LastEvaluatedKey"]["seq"]) if "LastEvaluatedKey" in ret.keys() else None
+		return history, cursor
+
+	def migrate_version_history(self):
+		"""Move version histories that are still stored in full inside user items out to the versions table. APIs
+		that already have a version_count have been migrated (or were created afterwards) and are skipped. Leaves a
+		marker in the catalog table once done so later startups don't rescan."""
+		users = self.dynamo.scan()["Items"]
+		for user in users:
+			for index, api in enumerate(user["apis"]):
+				if "version_count" in api.keys():
+					continue
+				with self.versions.batch_writer() as batch:
+					for seq, version in enumerate(api["versions"], start=1):
+						batch.put_item(Item=dict(version, api=api["id"], seq=seq))
+				self.dynamo.update_item(
+					Key={"username": user["username"]},
+					UpdateExpression="SET apis[{0}].versions = :recent, apis[{0}].version_count = :count".format(index),
+					ExpressionAttributeValues={
+						":recent": api["versions"][-HISTORY_PREVIEW:],
+						":count": len(api["versions"])
+					}
+				)
+				self.__publish(user["username"])
+		self.catalog.put_item(Item={"bucket": "versions-migrated", "time": int(time.time())})
+
 	def get_user_list(self):
 		"""Get a list of users and whether they're admin or not, as a list of tuples"""
-		users = self.dynamo.scan()["Items"]
+		users = self.__scan_users()
 		return [
 			{
 				"username": user["username"],
@@ -357,78 +485,185 @@ class APIDatabase:
 
 	def export_db_to_json(self, filename):
 		"""Export the API db to a certain format JSON file"""
+		totals = self.catalog.get_item(Key={"bucket": "totals"}).get("Item", {})
 		ret = {
-			"count": 0,
-			"totalCount": 0,
-			"size": 0,
-			"totalSize": 0,
+			"count": int(totals.get("count", 0)),
+			"totalCount": int(totals.get("totalCount", 0)),
+			"size": float(totals.get("size", 0)),
+			"totalSize": float(totals.get("totalSize", 0)),
 			"classes": []
 		}
 
-		# Collect aggregate stats
-		users = self.dynamo.scan()["Items"]
-		apis = []
+		# Aggregate stats and term ordering are maintained by the write path, so all that's left is to drop each
+		# visible API into its term bucket
+		terms = sorted(totals.get("terms", set()), reverse=True)
+		buckets = {term: [] for term in terms}
+		users = self.__scan_users()
 		for user in users:
 			for api in user["apis"]:
-				ret["totalCount"] += 1
-				ret["totalSize"] += float(api["size"])
-				if api["display"] == 1:
-					ret["count"] += 1
-					ret["size"] += float(api["size"])
-					apis.append(api)
-				api["creator"] = user["username"]
+				if api["display"] != 1:
+					continue
 				api["year"] = int(api["year"])
-		apis = sorted(apis, key=(lambda api: str(api["year"] - 1 if api["term"] > 'B' else api["year"]) + api["term"]), reverse=True)
-
-		# Assemble final structure
-		currTerm = None
-		currYear = None
-		index = -1
-		for api in apis:
-			apiInfo = self.get_api_info(api=api, user=api["creator"])
-			if (apiInfo["term"] != currTerm) or (apiInfo["year"] != currYear):
-				currTerm = apiInfo["term"]
-				currYear = apiInfo["year"]
-				index += 1
-				ret["classes"].append({
-					"term": currTerm,
-					"year": currYear,
-					"apis": []
-				})
-			ret["classes"][index]["apis"].append(apiInfo)
+				key = self.__term_key(api["term"], api["year"])
+				if key not in buckets:
+					# Missing from the term index somehow; slot it in rather than dropping the API from the listing
+					buckets[key] = []
+					terms = sorted(buckets.keys(), reverse=True)
+				buckets[key].append(self.get_api_info(api=api, user=user["username"]))
+
+		# Assemble final structure, with per-class stats straight from the term buckets
+		stats = self.__get_term_buckets(terms)
+		for term in terms:
+			if len(buckets[term]) == 0:
+				continue
+			ret["classes"].append({
+				"term": buckets[term][0]["term"],
+				"year": buckets[term][0]["year"],
+				"count": int(stats[term]["count"]) if term in stats.keys() else len(buckets[term]),
+				"size": float(stats[term]["size"]) if term in stats.keys() else sum(api["size"] for api in buckets[term]),
+				"apis": buckets[term]
+			})
 
 		self.bucket.put_object(Key=filename, Body=json.dumps(ret))
 
+	def rebuild_catalog_stats(self):
+		"""Recompute catalog aggregates and term buckets from scratch. Only needed to seed the counters; after that
+		they're kept up to date by every write that affects them."""
+		totals = {"bucket": "totals", "count": 0, "totalCount": 0, "size": 0, "totalSize": 0}
+		old_terms = self.catalog.get_item(Key={"bucket": "totals"}).get("Item", {}).get("terms", set())
+		buckets = {term: None for term in old_terms}
+		users = self.dynamo.scan()["Items"]
+		for user in users:
+			for api in user["apis"]:
+				totals["totalCount"] += 1
+				totals["totalSize"] += int(api["size"])
+				key = self.__term_key(api["term"], api["year"])
+				if buckets.get(key) is None:
+					buckets[key] = {"bucket": key, "term": api["term"], "year": int(api["year"]), "count": 0, "size": 0}
+				if api["display"] == 1:
+					totals["count"] += 1
+					totals["size"] += int(api["size"])
+					buckets[key]["count"] += 1
+					buckets[key]["size"] += int(api["size"])
+
+		# Buckets that no longer hold anything are zeroed rather than deleted, they stay in the term index
+		for key, bucket in buckets.items():
+			if bucket is None:
+				self.catalog.update_item(
+					Key={"bucket": key},
+					UpdateExpression="SET #count = :zero, #size = :zero",
+					ExpressionAttributeNames={"#count": "count", "#size": "size"},
+					ExpressionAttributeValues={":zero": 0}
+				)
+			else:
+				self.catalog.put_item(Item=bucket)
+		if len(buckets) > 0:
+			totals["terms"] = set(buckets.keys())
+		self.catalog.put_item(Item=totals)
+
+	def __adjust_catalog(self, term, year, count=0, size=0, total_count=0, total_size=0):
+		"""Atomically apply deltas to the catalog totals and to the term bucket an API lives in. count/size only
+		cover displayed APIs, total_count/total_size cover everything."""
+		key = self.__term_key(term, year)
+		self.catalog.update_item(
+			Key={"bucket": "totals"},
+			UpdateExpression="ADD #count :count, #size :size, totalCount :tcount, totalSize :tsize, terms :term",
+			ExpressionAttributeNames={"#count": "count", "#size": "size"},
+			ExpressionAttributeValues={
+				":count": count,
+				":size": size,
+				":tcount": total_count,
+				":tsize": total_size,
+				":term": {key}
+			}
+		)
+		self.catalog.update_item(
+			Key={"bucket": key},
+			UpdateExpression="SET #term = :term, #year = :year ADD #count :count, #size :size",
+			ExpressionAttributeNames={"#term": "term", "#year": "year", "#count": "count", "#size": "size"},
+			ExpressionAttributeValues={":term": term, ":year": int(year), ":count": count, ":size": size}
+		)
+
+	def __get_term_buckets(self, terms):
+		"""Get the catalog buckets for a list of term keys, as a dict keyed by term"""
+		ret = {}
+		for i in range(0, len(terms), 100):  # BatchGetItem takes at most 100 keys at a time
+			items = self.catalog.meta.client.batch_get_item(
+				RequestItems={self.catalog.name: {"Keys": [{"bucket": term} for term in terms[i:i + 100]]}}
+			)["Responses"].get(self.catalog.name, [])
+			ret.update({item["bucket"]: item for item in items})
+		return ret
+
+	def __scan_users(self):
+		"""Get every user item. After the first scan, only users that changed since are fetched again."""
+		self.__sync()
+		with self.lock:
+			users, stale, generation = self.users_cache, self.stale_users, self.generation
+			self.stale_users = set()
+		if users is None:
+			users = {user["username"]: user for user in self.dynamo.scan(ConsistentRead=True)["Items"]}
+		else:
+			users = dict(users)
+			for username in stale:
+				ret = self.dynamo.get_item(Key={"username": username}, ConsistentRead=True)
+				if "Item" in ret.keys():
+					users[username] = ret["Item"]
+				else:
+					users.pop(username, None)
+		with self.lock:
+			if self.generation == generation:
+				self.users_cache = users
+			else:
+				# Something changed while we were fetching, those users will need another look next time
+				self.stale_users |= stale
+		return list(users.values())
+
+	def __sync(self, force=False):
+		"""Invalidate cached users that other nodes have changed since we last looked. Polls the change sequence at
+		most once per poll interval, unless forced; writes force it, and cache fills read consistently, so they
+		never act on stale data."""
+		now = time.time()
+		if not force and now - self.last_poll < self.poll_interval:
+			return
+		self.last_poll = now
+		latest = self.changes.current()
+		if latest <= self.seen:
+			return
+		self.__invalidate(self.changes.since(self.seen, latest))
+		self.seen = latest
+
+	def __publish(self, *usernames):
+		"""Record a change to the given users' items, both in our own cache and in the shared change feed"""
+		self.__invalidate(usernames)
+		self.changes.publish(*usernames)
+
+	def __invalidate(self, usernames):
+		"""Drop the given users from the cache and mark them for re-fetching in the full scan. None means anything
+		could have changed and everything goes."""
+		with self.lock:
+			self.generation += 1
+			if usernames is None:
+				self.user_cache.clear()
+				self.users_cache = None
+				self.stale_users = set()
+			else:
+				for username in usernames:
+					self.user_cache.pop(username, None)
+				self.stale_users |= set(usernames)
+
+	@staticmethod
+	def __term_key(term, year):
+		"""Catalog ordering key for a term. C and D terms belong to the previous academic year, so these keys sort
+		lexicographically in academic order."""
+		year = int(year)
+		return str(year - 1 if term > "B" else year) + term
+
 	def __get_api_chain_by_id(self, api_id):
 		"""Get an API chain by ID -- that means the API object and the user that owns it"""
-		users = self.dynamo.scan()["Items"]
+		users = self.__scan_users()
 		users = list(filter(lambda user: len(list(filter(lambda api: api_id == api["id"], user["apis"]))) > 0, users))
 		if len(users) == 0:
 			return False, "Could not find API"
 		current_user = users[0]
 		current_api = list(filter(lambda api: api_id == api["id"], current_user["apis"]))[0]
 		return current_api, current_user
-
-	@staticmethod
-	def __validate_args(**kwargs):
-		"""Validates select API info args. Returns true if they check out, false otherwise"""
-		if "contact" in kwargs.keys():
-			# Simple email validation -- make sure there's exactly one @ with text before and after it
-			if re.search("^[^@]+@[^@]+$", kwargs["contact"]) is None:
-				return False
-		if "term" in kwargs.keys():
-			if kwargs["term"] not in ["A", "B", "C", "D"]:
-				return False
-		if "year" in kwargs.keys():
-			if re.search("^\d{4}$", str(kwargs["year"])) is None:
-				return False
-		if "team" in kwargs.keys():
-			if re.search("^[A-Z]$", kwargs["team"]) is None or len(kwargs["team"]) > 1:
-				return False
-		if "version" in kwargs.keys():
-			if re.search("^\d+\.\d+\.\d+", kwargs["version"]) is None:
-				return False
-		if "description" in kwargs.keys():  # Anti-XSS, somehow showdown.js lets this get by in [](link) format
-			if re.search("\(.*javascript:.*\)", kwargs["description"]) is not None:
-				return False
-		return True
@@ -0,0 +1,148 @@
+import base64
+import binascii
+import re
+
+from flask_restplus import reqparse
+
+# Upload size limits (decoded), checked against the base64 length before anything gets decoded
+MAX_JAR_SIZE = 50 * 1000 * 1000
+MAX_IMAGE_SIZE = 5 * 1000 * 1000
+
+# Largest request body worth reading at all: one of each upload, base64-encoded, plus some room for everything else
+MAX_CONTENT_LENGTH = (MAX_JAR_SIZE + MAX_IMAGE_SIZE) * 4 // 3 + 64 * 1000
+
+# Matched with fullmatch (or match, for the version prefix) rather than ^...$, since $ also matches before a
+# trailing newline
+CONTACT = re.compile(r"[^@\s]+@[^@\s]+")  # Simple email validation -- exactly one @ with text before and after it
+YEAR = re.compile(r"[0-9]{4}")
+TEAM = re.compile(r"[A-Z]")
+VERSION = re.compile(r"([0-9]+\.[0-9]+\.[0-9]+)")
+SCRIPT_LINK = re.compile(r"\(.*javascript:.*\)")  # Anti-XSS, somehow showdown.js lets this get by in [](link) format
+TERMS = ("A", "B", "C", "D")
+
+# Fields required to create an API; versions and uploads only come in through updates
+CREATE_FIELDS = ("name", "contact", "description", "term", "year", "team")
+
+
+# Request parsers, built once and shared by every request
+
+credentials_parser = reqparse.RequestParser()
+credentials_parser.add_argument("username", required=True, type=str)
+credentials_parser.add_argument("password", required=True, type=str)
+
+api_change_parser = reqparse.RequestParser()
+api_change_parser.add_argument("action", help="Action (create, update)", required=True, type=str)
+api_change_parser.add_argument("info", help="Info structure", required=True, type=dict)
+api_change_parser.add_argument("id", help="API ID (update only)", required=False, type=str)
+
+api_id_parser = reqparse.RequestParser()
+api_id_parser.add_argument("id", help="API ID", required=True, type=str)
+
+api_history_parser = reqparse.RequestParser()
+api_history_parser.add_argument("id", required=True, type=str)
+api_history_parser.add_argument("before", help="Cursor returned with the previous page", required=False, type=int)
+api_history_parser.add_argument("limit", help="Page size (max 100)", required=False, type=int, default=20)
+
+user_modify_parser = reqparse.RequestParser()
+user_modify_parser.add_argument("username", required=True, type=str)
+user_modify_parser.add_argument("new_username", required=False, type=str)
+user_modify_parser.add_argument("new_password", required=False, type=str)
+user_modify_parser.add_argument("set_admin", required=False, type=bool)
+user_modify_parser.add_argument("lock", required=False, type=bool)
+
+username_parser = reqparse.RequestParser()
+username_parser.add_argument("username", required=True, type=str)
+
+
+# API info field validators. Each takes the raw JSON value and returns it cleaned up, or raises ValueError
+
+def _text(value):
+	if not isinstance(value, str):
+		raise ValueError("Text fields must be strings")
+	return value
+
+
+def _contact(value):
+	if CONTACT.fullmatch(_text(value)) is None:
+		raise ValueError("Contact must be an email address")
+	return value
+
+
+def _description(value):
+	if SCRIPT_LINK.search(_text(value)) is not None:
+		raise ValueError("Description contains a script link")
+	return value
+
+
+def _term(value):
+	if value not in TERMS:
+		raise ValueError("Term must be one of A, B, C, D")
+	return value
+
+
+def _year(value):
+	if YEAR.fullmatch(str(value)) is None:
+		raise ValueError("Year must be four digits")
+	return int(value)
+
+
+def _team(value):
+	if TEAM.fullmatch(_text(value)) is None:
+		raise ValueError("Team must be a single capital letter")
+	return value
+
+
+def _version(value):
+	"""Split a version into its number and the free text that follows it"""
+	match = VERSION.match(_text(value))
+	if match is None:
+		raise ValueError("Version must start with a version number (e.g. 1.0.0)")
+	return {"vnumber": match.group(1), "info": value.replace(match.group(1), "").lstrip()}
+
+
+def _upload(limit, what):
+	def decode(value):
+		if len(_text(value)) * 3 // 4 > limit:
+			raise ValueError("{} too large, max is {} MB".format(what, limit // 1000000))
+		try:
+			return base64.standard_b64decode(value)
+		except binascii.Error:
+			raise ValueError("{} isn't valid base64".format(what))
+	return decode
+
+
+API_FIELDS = {
+	"name": _text,
+	"contact": _contact,
+	"description": _description,
+	"term": _term,
+	"year": _year,
+	"team": _team,
+	"version": _version,
+	"image": _upload(MAX_IMAGE_SIZE, "Image"),
+	"jar": _upload(MAX_JAR_SIZE, "Jar file"),
+}
+
+
+def parse_api_info(info, create=False):
+	"""Validate an API info structure in a single pass. Returns a tuple of success and either the cleaned info dict
+	(year as an int, version split up, uploads decoded) or an error message. Creation ignores fields it doesn't use,
+	updates reject anything unknown since the keys end up in update expressions."""
+	ret = {}
+	for key, value in info.items():
+		if key not in (CREATE_FIELDS if create else API_FIELDS.keys()):
+			if create:
+				continue
+			return False, "Illegal API change argument"
+		try:
+			ret[key] = API_FIELDS[key](value)
+		except ValueError as e:
+			return False, str(e)
+
+	if create and not all(key in ret.keys() for key in CREATE_FIELDS):
+		return False, "Not enough arguments (name, contact, description, term, year, team)"
+
+	# Jars must be accompanied by versions; if we have one but not the other, throw an error
+	if ("jar" in ret.keys()) != ("version" in ret.keys()):
+		return False, "Jar files must be accompanied by versions" if "jar" in ret.keys() else "Empty versions disallowed"
+	return True, ret
@@ -1,12 +1,16 @@
 import datetime
 from json import loads
 
-from flask import Flask, Blueprint
+from flask import Flask, Blueprint, request
 from flask_cors import CORS
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, JWTManager
-from flask_restplus import Api, Resource, reqparse
+from flask_restplus import Api, Resource
 
+from changes import LocalChangeFeed
 from db import APIDatabase
+from schemas import MAX_CONTENT_LENGTH, credentials_parser, api_change_parser, api_id_parser, api_history_parser, \
+	user_modify_parser, username_parser, parse_api_info
+from snapshot import CatalogSnapshot
 
 # Load configuration
 conf = {
@@ -15,14 +19,20 @@ conf = {
 		"jwt-key": "DEFAULT_SECRET_KEY",
 		"img-dir": "img",
 		"jar-dir": "maven",
-		"json-output": "list.json"
+		"json-output": "list.json",
+		"change-feed": "dynamo",
+		"change-poll-interval": 2,
+		"snapshot-reads": False,
+		"snapshot-reload-interval": 10
 	},
 	"aws": {
 		"region": "us-east-1",
 		"access-key": "",
 		"secret-key": "",
 		"dynamo": {
-			"table": "apisite"
+			"table": "apisite",
+			"catalog-table": "apisite-catalog",
+			"versions-table": "apisite-versions"
 		},
 		"s3": {
 			"bucket": "apisite.crmyers.dev"
@@ -40,6 +50,7 @@ aws_conf = conf["aws"]
 # Set up flask
 app = Flask(__name__)
 app.config["JWT_SECRET_KEY"] = conf["server"]["jwt-key"]
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH  # Only enforced by form parsing, see reject_oversized below
 CORS(app)
 jwt = JWTManager(app)
 apiV1 = Blueprint('api', __name__)
@@ -49,8 +60,18 @@ app.register_blueprint(apiV1)
 jwt._set_error_handler_callbacks(api)  # plz stop returning 500 Server Error
 ns = api.namespace("", description="API list functionality")
 
-db = APIDatabase(server_conf["img-dir"], server_conf["jar-dir"], aws_conf["dynamo"]["table"], aws_conf["region"],
-				 aws_conf["s3"]["bucket"], aws_conf["access-key"], aws_conf["secret-key"])
+db = APIDatabase(server_conf["img-dir"], server_conf["jar-dir"], aws_conf["dynamo"]["table"],
+				 aws_conf["dynamo"].get("catalog-table", "apisite-catalog"),
+				 aws_conf["dynamo"].get("versions-table", "apisite-versions"), aws_conf["region"],
+				 aws_conf["s3"]["bucket"], aws_conf["access-key"], aws_conf["secret-key"],
+				 changes=LocalChangeFeed() if server_conf.get("change-feed", "dynamo") == "local" else None,
+				 poll_interval=server_conf.get("change-poll-interval", 2))
+
+# Optionally serve catalog reads from the last exported list instead of the live database
+snapshot = None
+if server_conf.get("snapshot-reads", False):
+	snapshot = CatalogSnapshot(db.bucket, server_conf["json-output"], server_conf.get("snapshot-reload-interval", 10))
+	snapshot.refresh(force=True)
 
 
 def response(success, message, descriptor=None, payload=None):
@@ -61,6 +82,17 @@ def response(success, message, descriptor=None, payload=None):
 		return {"status": "success" if success else "error", "message": message, descriptor: payload}
 
 
+@app.before_request
+def reject_oversized():
+	"""Turn away requests whose declared length is over the limit before anything reads the body. reqparse goes
+	through request.json, which buffers the whole stream without looking at MAX_CONTENT_LENGTH. Chunked bodies
+	don't declare a length up front, so they're refused outright."""
+	if request.content_length is None and "chunked" in request.headers.get("Transfer-Encoding", "").lower():
+		return response(False, "Chunked request bodies aren't supported, send a Content-Length"), 411
+	if request.content_length is not None and request.content_length > MAX_CONTENT_LENGTH:
+		return response(False, "Request too large"), 413
+
+
 # Helper wrapper to make admin privilege checking smoother
 def admin_required(func):
 	def wrapper(self):
@@ -78,21 +110,14 @@ def admin_required(func):
 class Register(Resource):
 	def post(self):
 		"""Register new user"""
-		parser = reqparse.RequestParser()
-		parser.add_argument("username", required=True, type=str)
-		parser.add_argument("password", required=True, type=str)
-
-		args = parser.parse_args()
+		args = credentials_parser.parse_args()
 		if not db.register_user(args["username"], args["password"]):
 			return response(False, "Registration failed"), 403
 		return response(True, "Successfully registered as user {}".format(args["username"])), 201
 
 	def delete(self):
 		"""Delete user, requires password as confirmation"""
-		parser = reqparse.RequestParser()
-		parser.add_argument("username", required=True, type=str)
-		parser.add_argument("password", required=True, type=str)
-		args = parser.parse_args()
+		args = credentials_parser.parse_args()
 		if db.authenticate(args["username"], args["password"]):
 			db.delete_user(args["username"])
 			db.export_db_to_json(server_conf["json-output"])
@@ -105,11 +130,7 @@ class Register(Resource):
 class Login(Resource):
 	def post(self):
 		"""Login, return a token"""
-		parser = reqparse.RequestParser()
-		parser.add_argument("username", required=True, type=str)
-		parser.add_argument("password", required=True, type=str)
-
-		args = parser.parse_args()
+		args = credentials_parser.parse_args()
 		auth, admin, locked = db.authenticate(args["username"], args["password"])
 		if not auth:
 			return response(False, "Invalid credentials"), 401
@@ -133,36 +154,30 @@ class List(Resource):
 		if db.get_user(get_jwt_identity()) is None:
 			return response(False, "User does not exist", "username", get_jwt_identity()), 401
 
-		parser = reqparse.RequestParser()
-		parser.add_argument("action", help="Action (create, update)", required=True, type=str)
-		parser.add_argument("info", help="Info structure", required=True, type=dict)
-		args = parser.parse_args()
+		args = api_change_parser.parse_args()
 		action = args["action"]
 
 		if action == "create":
-			required = ("name", "description", "term", "year", "team")
-			if all(key in args["info"] for key in required):
-				info = args["info"]
-				res, apiID = db.create_api(get_jwt_identity(), info["name"], info["contact"], info["description"],
-										   info["term"],
-										   info["year"], info["team"])
-				if res:
-					db.export_db_to_json(server_conf["json-output"])
-					return response(True, "Created API '{}'".format(info["name"]), "id", apiID), 201
-				else:
-					return response(False, "Failed to create API '{}': {}".format(info["name"], apiID)), 400
+			ok, info = parse_api_info(args["info"], create=True)
+			if not ok:
+				return response(False, "Failed to create API: {}".format(info)), 400
+			res, apiID = db.create_api(get_jwt_identity(), info)
+			if res:
+				db.export_db_to_json(server_conf["json-output"])
+				return response(True, "Created API '{}'".format(info["name"]), "id", apiID), 201
 			else:
-				return response(False,
-								"Failed to create API< not enough arguments (name, contact, description, term, year, team)"), 400
+				return response(False, "Failed to create API '{}': {}".format(info["name"], apiID)), 400
 
 		elif action == "update":
-			parser.add_argument("id", help="API ID", required=True, type=str)
-			args = parser.parse_args()
-
+			if args["id"] is None:
+				return response(False, "Missing API ID"), 400
 			if len(args["info"].keys()) == 0:
 				return response(False, "Didn't include any data to update"), 400
+			ok, info = parse_api_info(args["info"])
+			if not ok:
+				return response(False, info, "id", args["id"]), 400
 
-			stat, message = db.update_api(get_jwt_identity(), args["id"], **args["info"])
+			stat, message = db.update_api(get_jwt_identity(), args["id"], info)
 			db.export_db_to_json(server_conf["json-output"])
 			return response(stat, message, "id", args["id"]), 200 if stat else 400
 
@@ -172,9 +187,7 @@ class List(Resource):
 		if db.get_user(get_jwt_identity()) is None:
 			return {"message": "User does not exist", "username": get_jwt_identity()}, 401
 
-		parser = reqparse.RequestParser()
-		parser.add_argument("id", help="API ID", required=True, type=str)
-		args = parser.parse_args()
+		args = api_id_parser.parse_args()
 
 		if db.delete_api(get_jwt_identity(), args["id"]):
 			db.export_db_to_json(server_conf["json-output"])
@@ -184,17 +197,42 @@ class List(Resource):
 
 	def get(self):
 		"""Get information on an API, using its ID or its artifact+groupID"""
-		parser = reqparse.RequestParser()
-		parser.add_argument("id", required=True, type=str)
-		args = parser.parse_args()
+		args = api_id_parser.parse_args()
 
 		# Python won't let me do C-style assignments in if statements, so yeah, there's duped code here. Deal with it.
-		res = db.get_api_info(args["id"])
+		res = db.get_api_info(args["id"]) if snapshot is None else snapshot.get_api_info(args["id"])
 		if res is None:
 			return response(False, "Failed to find API", "id", args["id"]), 400
 		return res
 
 
+@ns.route("/list/history")
+class History(Resource):
+	def get(self):
+		"""Get an API's version history, newest first, one page at a time"""
+		args = api_history_parser.parse_args()
+
+		if args["limit"] < 1 or args["limit"] > 100:
+			return response(False, "Page size must be between 1 and 100", "id", args["id"]), 400
+		# Snapshots only carry the most recent versions, anything older still has to come from the database. IDs the
+		# snapshot doesn't know about are reported missing without asking the database, same as GET /list.
+		page = None
+		if snapshot is None or snapshot.get_api_info(args["id"]) is not None:
+			page = None if snapshot is None else snapshot.get_api_history(args["id"], args["before"], args["limit"])
+			if page is None:
+				page = db.get_api_history(args["id"], args["before"], args["limit"])
+		if page is None:
+			return response(False, "Failed to find API", "id", args["id"]), 400
+		history, cursor = page
+		return {
+				   "status": "success",
+				   "message": "Retrieved {} versions".format(len(history)),
+				   "id": args["id"],
+				   "history": history,
+				   "next": cursor
+			   }, 200
+
+
 @ns.route("/admin")
 class Admin(Resource):
 	"""Endpoints for the admin access feature"""
@@ -210,13 +248,7 @@ class Admin(Resource):
 	@admin_required
 	def post(self):
 		"""Modify user"""
-		parser = reqparse.RequestParser()
-		parser.add_argument("username", required=True, type=str)
-		parser.add_argument("new_username", required=False, type=str)
-		parser.add_argument("new_password", required=False, type=str)
-		parser.add_argument("set_admin", required=False, type=bool)
-		parser.add_argument("lock", required=False, type=bool)
-		args = parser.parse_args()
+		args = user_modify_parser.parse_args()
 
 		if db.get_user(args["username"]) is None:
 			return response(False, "User does not exist"), 400
@@ -246,9 +278,7 @@ class Admin(Resource):
 	@admin_required
 	def delete(self):
 		"""Delete a user"""
-		parser = reqparse.RequestParser()
-		parser.add_argument("username", required=True, type=str)
-		username = parser.parse_args()["username"]
+		username = username_parser.parse_args()["username"]
 		if db.get_user(username) is None:
 			return response(False, "User does not exist"), 400
 		db.delete_user(username)
@@ -0,0 +1,66 @@
+import json
+import time
+
+from botocore.exceptions import ClientError
+
+
+class CatalogSnapshot:
+	"""Read-only copy of the catalog, built from the exported list JSON in S3. Lets a node answer catalog reads
+	without touching DynamoDB at all; it picks up a newer export once the reload interval has passed."""
+
+	def __init__(self, bucket, key, reload_interval=10):
+		self.bucket = bucket
+		self.key = key
+		self.reload_interval = reload_interval
+		self.last_check = 0
+		self.etag = None
+		self.apis = {}
+
+	def refresh(self, force=False):
+		"""Reload the snapshot if a newer export has been published. The new index is built on the side and swapped
+		in with a single assignment, so readers only ever see a complete snapshot."""
+		now = time.time()
+		if not force and now - self.last_check < self.reload_interval:
+			return
+		self.last_check = now
+		try:
+			if self.etag is None:
+				ret = self.bucket.Object(self.key).get()
+			else:
+				ret = self.bucket.Object(self.key).get(IfNoneMatch=self.etag)
+		except ClientError as e:
+			if e.response["Error"]["Code"] not in ("304", "NotModified"):
+				print("Couldn't load catalog snapshot '{}': {}".format(self.key, e))
+			return
+
+		doc = json.loads(ret["Body"].read())
+		self.apis = {api["id"]: api for term in doc["classes"] for api in term["apis"]}
+		self.etag = ret["ETag"]
+
+	def get_api_info(self, api_id):
+		"""Get an API info dict by ID, or None if it isn't in the snapshot (which only has displayed APIs)"""
+		self.refresh()
+		return self.apis.get(api_id)
+
+	def get_api_history(self, api_id, before=None, limit=20):
+		"""Same as APIDatabase.get_api_history, but only covers the recent versions the export carries. Returns None
+		if the API isn't in the snapshot or the page asked for goes further back than that, in which case the
+		database has to answer instead."""
+		api = self.get_api_info(api_id)
+		if api is None:
+			return None
+
+		# The preview holds the newest versions, oldest first, so the last entry's sequence number is the count
+		count = api.get("historyCount", len(api["history"]))
+		first = count - len(api["history"]) + 1
+		newest = count if before is None else min(before - 1, count)
+		if newest <= 0:
+			return [], None
+		if newest < first:
+			return None
+		oldest = max(newest - limit + 1, first)
+		history = [api["history"][seq - first] for seq in range(newest, oldest - 1, -1)]
+
+		# Always strictly below where this page started, so following the cursor can only ever move backwards
+		cursor = oldest if oldest > 1 else None
+		return history, cursor